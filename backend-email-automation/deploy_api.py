@@ -2,27 +2,26 @@ import asyncio
 from typing import Optional
 from fastapi import FastAPI, Query, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from langserve import add_routes
 from src.graph import Workflow
+from src.nodes import EmailServiceType, detect_service
+from src.cache import flush_caches
 from dotenv import load_dotenv
 from src.tools.GmailTools import GmailToolsClass
 from src.tools.enhanced_outlook_tools import EnhancedOutlookTools
 from datetime import datetime, timedelta
+from types import SimpleNamespace
 from collections import defaultdict
-import pytz
+from cachetools import TTLCache
+import functools
+import math
+import numpy as np
 import os
-from enum import Enum
+import sys
+import time
 import logging
 
-async def fetch_email_chunk(email_tools, start_hours: int, chunk_hours: int):
-    """Helper function to fetch a chunk of emails"""
-    try:
-        chunk = email_tools.fetch_recent_emails(hours=chunk_hours)
-        return chunk if chunk else []
-    except Exception as e:
-        logger.error(f"Error fetching email chunk: {str(e)}")
-        return []
-
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -30,7 +29,17 @@ logger = logging.getLogger(__name__)
 # Load .env file
 load_dotenv()
 
+# Resolve environment configuration once at startup
+DEFAULT_EMAIL = os.getenv('DEFAULT_EMAIL')
+if not DEFAULT_EMAIL:
+    raise ValueError("DEFAULT_EMAIL environment variable must be set")
+
+OUTLOOK_CREDS_PRESENT = all(
+    os.getenv(var) for var in ('OUTLOOK_CLIENT_ID', 'OUTLOOK_CLIENT_SECRET', 'OUTLOOK_TENANT_ID')
+)
+
 app = FastAPI(
+    default_response_class=ORJSONResponse,
     title="Email Automation",
     version="1.0",
     description="LangGraph backend for the AI email automation workflow",
@@ -46,10 +55,6 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
-class EmailServiceType(Enum):
-    GMAIL = "gmail"
-    OUTLOOK = "outlook"
-
 class EmailToolFactory:
     @staticmethod
     def create_email_tool(service_type: EmailServiceType, email_address: str = None):
@@ -57,11 +62,7 @@ class EmailToolFactory:
             if service_type == EmailServiceType.GMAIL:
                 return GmailToolsClass()
             elif service_type == EmailServiceType.OUTLOOK:
-                if not all([
-                    os.getenv('OUTLOOK_CLIENT_ID'),
-                    os.getenv('OUTLOOK_CLIENT_SECRET'),
-                    os.getenv('OUTLOOK_TENANT_ID')
-                ]):
+                if not OUTLOOK_CREDS_PRESENT:
                     raise ValueError("Missing required Outlook environment variables")
                 return EnhancedOutlookTools(email_address)
             else:
@@ -70,30 +71,150 @@ class EmailToolFactory:
             logger.error(f"Error creating email tool: {str(e)}")
             raise
 
-def detect_service(email_address: str) -> EmailServiceType:
-    try:
-        email_domain = email_address.lower().split('@')[1]
-        if 'gmail.com' in email_domain:
-            return EmailServiceType.GMAIL
-        elif any(domain in email_domain for domain in ['outlook.com', 'hotmail.com', 'live.com', 'office365.com']):
-            return EmailServiceType.OUTLOOK
-        return EmailServiceType.GMAIL  # Default to Gmail for custom domains
-    except Exception as e:
-        logger.error(f"Error detecting email service: {str(e)}")
-        return EmailServiceType.GMAIL
-
 # Initialize Email Tools with default email
-default_email = os.getenv('DEFAULT_EMAIL')
-if not default_email:
-    raise ValueError("DEFAULT_EMAIL environment variable must be set")
-
 try:
-    current_service = detect_service(default_email)
-    email_tools = EmailToolFactory.create_email_tool(current_service, default_email)
+    current_service = detect_service(DEFAULT_EMAIL)
+    email_tools = EmailToolFactory.create_email_tool(current_service, DEFAULT_EMAIL)
 except Exception as e:
     logger.error(f"Error initializing email tools: {str(e)}")
     raise
 
+# Gmail labels that count an email as replied
+REPLIED_LABELS = frozenset({'SENT', 'INBOX'})
+
+# datetime.fromisoformat only accepts a trailing 'Z' from Python 3.11 on
+if sys.version_info >= (3, 11):
+    parse_iso = datetime.fromisoformat
+else:
+    _UTC_SUFFIX = str.maketrans({'Z': '+00:00'})
+
+    def parse_iso(value: str) -> datetime:
+        return datetime.fromisoformat(value.translate(_UTC_SUFFIX))
+
+def parse_iso_timestamp(value: str) -> float:
+    """Convert an ISO-8601 string (as returned by Graph) to a POSIX timestamp"""
+    return parse_iso(value).timestamp()
+
+def normalize_gmail_email(email: dict) -> SimpleNamespace:
+    """Reduce a raw Gmail message to its internalDate, threadId and labelIds flags"""
+    labels = frozenset(email.get('labelIds') or ())
+    timestamp = None
+    if email.get('internalDate'):
+        try:
+            timestamp = int(email['internalDate']) / 1000
+        except Exception as e:
+            logger.warning(f"Error parsing email timestamp: {str(e)}")
+
+    return SimpleNamespace(
+        ts=timestamp,
+        thread=email.get('threadId'),
+        labels=labels,
+        is_unread='UNREAD' in labels,
+        is_sent_by_me='SENT' in labels,
+        is_replied=bool(labels & REPLIED_LABELS),
+        raw=email
+    )
+
+def normalize_outlook_email(email: dict) -> SimpleNamespace:
+    """Reduce a raw Outlook message to its receivedDateTime, conversationId, isRead and sender"""
+    timestamp = None
+    if email.get('receivedDateTime'):
+        try:
+            timestamp = parse_iso_timestamp(email['receivedDateTime'])
+        except Exception as e:
+            logger.warning(f"Error parsing email timestamp: {str(e)}")
+
+    is_sent_by_me = email.get('from', {}).get('emailAddress', {}).get('address') == DEFAULT_EMAIL
+    return SimpleNamespace(
+        ts=timestamp,
+        thread=email.get('conversationId'),
+        labels=frozenset(),
+        is_unread=not email.get('isRead', True),
+        is_sent_by_me=is_sent_by_me,
+        is_replied=is_sent_by_me,
+        raw=email
+    )
+
+# The service is fixed for the lifetime of the process, so pick the normalizer once
+normalize_email = (
+    normalize_gmail_email if current_service == EmailServiceType.GMAIL else normalize_outlook_email
+)
+
+# Fetch emails in 1-week windows, at most FETCH_CONCURRENCY at a time
+EMAIL_WINDOW_HOURS = 168
+FETCH_CONCURRENCY = 5
+
+async def as_completed_with_concurrency(n: int, *coros):
+    """Yield coroutine results as they complete, with at most `n` in flight at once"""
+    semaphore = asyncio.Semaphore(n)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    for next_result in asyncio.as_completed([run(coro) for coro in coros]):
+        yield await next_result
+
+async def run_email_tool(func, *args, **kwargs):
+    """Await async email tool methods; run blocking ones in a worker thread off the event loop"""
+    if asyncio.iscoroutinefunction(func):
+        return await func(*args, **kwargs)
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+# Short-lived cache so dashboard polls don't hit the Gmail/Graph APIs every time
+EMAIL_CACHE_TTL = 60
+email_cache = TTLCache(maxsize=64, ttl=EMAIL_CACHE_TTL)
+email_cache_lock = asyncio.Lock()
+
+async def cached_email_tool_call(key: tuple, func, *args, **kwargs):
+    """Serve an email tool call from the TTL cache, keyed by service, account and `key`"""
+    key = (current_service, DEFAULT_EMAIL) + key
+    async with email_cache_lock:
+        if key in email_cache:
+            return email_cache[key]
+    result = await run_email_tool(func, *args, **kwargs)
+    async with email_cache_lock:
+        email_cache[key] = result
+    return result
+
+async def fetch_email_window(email_tools, start_hour: int, window_hours: int):
+    """Helper function to fetch the emails received in one time window"""
+    try:
+        logger.info(f"Fetching emails from hour {start_hour} to {start_hour + window_hours}")
+        window = await cached_email_tool_call(
+            ("recent", start_hour, window_hours),
+            email_tools.fetch_recent_emails, hours=window_hours, start_hour=start_hour
+        )
+        return window if window else []
+    except Exception as e:
+        logger.error(f"Error fetching email window: {str(e)}")
+        return []
+
+async def iter_recent_emails(email_tools, hours: int):
+    """
+    Yield the normalized emails of the last `hours`, one disjoint weekly window at a time,
+    as soon as each window's fetch completes. Emails already yielded by an
+    overlapping window are skipped.
+    """
+    seen_ids = set()
+    windows = as_completed_with_concurrency(
+        FETCH_CONCURRENCY,
+        *[
+            fetch_email_window(email_tools, start_hour, min(EMAIL_WINDOW_HOURS, hours - start_hour))
+            for start_hour in range(0, hours, EMAIL_WINDOW_HOURS)
+        ]
+    )
+    async for window in windows:
+        emails = []
+        for email in window:
+            email_id = email.get('id') or email.get('internetMessageId')
+            if email_id is not None:
+                if email_id in seen_ids:
+                    continue
+                seen_ids.add(email_id)
+            emails.append(normalize_email(email))
+        yield emails
+
 @app.get("/api/email-stats")
 async def get_email_stats(
     hours: int = Query(default=24, ge=1),
@@ -102,26 +223,28 @@ async def get_email_stats(
     try:
         logger.info(f"Fetching email stats for hours: {hours}, account: {account}")
         
-        # Process in smaller chunks to avoid timeouts
-        total_hours = hours
-        chunk_size = min(168, total_hours)  # Process in 1-week chunks or less
-        recent_emails = []
-        
-        for start_hour in range(0, total_hours, chunk_size):
-            chunk_hours = min(chunk_size, total_hours - start_hour)
-            logger.info(f"Fetching chunk from hour {start_hour} to {start_hour + chunk_hours}")
-            
-            try:
-                chunk = email_tools.fetch_recent_emails(hours=chunk_hours)
-                if chunk:
-                    recent_emails.extend(chunk)
-            except Exception as chunk_error:
-                logger.error(f"Error fetching chunk: {chunk_error}")
-                continue
-
-        drafts = email_tools.fetch_draft_replies()
+        # Aggregate each window as it arrives instead of holding every email
+        total_emails = 0
+        unread_count = 0
+        replied_count = 0
+        # Earliest received time and all reply times per thread
+        first_received = {}
+        reply_times = defaultdict(list)
+        async for emails in iter_recent_emails(email_tools, hours):
+            for email in emails:
+                total_emails += 1
+                unread_count += email.is_unread
+                replied_count += email.is_replied
+                if email.ts is None:
+                    continue
+                if email.is_sent_by_me:
+                    reply_times[email.thread].append(email.ts)
+                elif email.ts < first_received.get(email.thread, math.inf):
+                    first_received[email.thread] = email.ts
+
+        drafts = await cached_email_tool_call(("drafts",), email_tools.fetch_draft_replies)
         
-        if not recent_emails:
+        if not total_emails:
             return {
                 "total": 0,
                 "unread": 0,
@@ -131,81 +254,22 @@ async def get_email_stats(
                 "avgResponse": 0
             }
             
-        total_emails = len(recent_emails)
-        
-        # Calculate basic stats with improved accuracy
-        if current_service == EmailServiceType.GMAIL:
-            # For Gmail
-            unread_count = sum(1 for email in recent_emails if 'UNREAD' in email.get('labelIds', []))
-            read_count = total_emails - unread_count
-            replied_count = sum(1 for email in recent_emails 
-                              if any(label in email.get('labelIds', []) 
-                                    for label in ['SENT', 'INBOX']))
-        else:
-            # For Outlook
-            unread_count = sum(1 for email in recent_emails if not email.get('isRead', True))
-            read_count = total_emails - unread_count
-            # Improved replied detection for Outlook
-            replied_count = sum(1 for email in recent_emails 
-                              if email.get('from', {}).get('emailAddress', {}).get('address') == default_email)
-            
+        read_count = total_emails - unread_count
         drafted_count = len(drafts)
 
         # Calculate average response time with improved accuracy
         total_response_time = 0
         response_count = 0
         
-        # Process each email thread for response time calculation
-        processed_threads = set()
-        
-        for email in sorted(recent_emails, key=lambda x: x.get('internalDate', '0') 
-                          if current_service == EmailServiceType.GMAIL 
-                          else x.get('receivedDateTime', '')):
-            try:
-                thread_id = email.get('threadId') if current_service == EmailServiceType.GMAIL else email.get('conversationId')
-                
-                # Skip if we've already processed this thread
-                if thread_id in processed_threads:
-                    continue
-                    
-                processed_threads.add(thread_id)
-                
-                if current_service == EmailServiceType.GMAIL:
-                    received_time = int(email.get('internalDate', '0')) / 1000
-                    
-                    # Find the first reply in this thread
-                    replies = [e for e in recent_emails 
-                             if e.get('threadId') == thread_id 
-                             and 'SENT' in e.get('labelIds', [])
-                             and int(e.get('internalDate', '0')) / 1000 > received_time]
-                    
-                    if replies:
-                        reply_time = int(replies[0].get('internalDate', '0')) / 1000
-                        response_time = reply_time - received_time
-                        if response_time > 0:
-                            total_response_time += response_time
-                            response_count += 1
-                            
-                else:  # Outlook
-                    if email.get('receivedDateTime'):
-                        received_time = datetime.fromisoformat(email['receivedDateTime'].replace('Z', '+00:00'))
-                        
-                        # Find replies in the conversation
-                        replies = [e for e in recent_emails 
-                                 if e.get('conversationId') == email.get('conversationId')
-                                 and e.get('from', {}).get('emailAddress', {}).get('address') == default_email
-                                 and datetime.fromisoformat(e['receivedDateTime'].replace('Z', '+00:00')) > received_time]
-                        
-                        if replies:
-                            reply_time = datetime.fromisoformat(replies[0]['receivedDateTime'].replace('Z', '+00:00'))
-                            response_time = (reply_time - received_time).total_seconds()
-                            if response_time > 0:
-                                total_response_time += response_time
-                                response_count += 1
-                                
-            except Exception as e:
-                logger.warning(f"Error processing email for response time: {str(e)}")
-                continue
+        # First reply after the first received email of each thread
+        for thread_id, received_time in first_received.items():
+            reply_time = min(
+                (ts for ts in reply_times.get(thread_id, ()) if ts > received_time),
+                default=None
+            )
+            if reply_time is not None:
+                total_response_time += reply_time - received_time
+                response_count += 1
 
         # Calculate average response time in hours
         avg_response = 0
@@ -238,49 +302,21 @@ async def get_email_activity(
     try:
         logger.info(f"Fetching email activity for hours: {hours}")
         
-        # Process in smaller chunks to avoid timeouts
-        chunk_size = min(168, hours)  # Process in 1-week chunks or less
-        recent_emails = []
-        
-        for start_hour in range(0, hours, chunk_size):
-            chunk_hours = min(chunk_size, hours - start_hour)
-            logger.info(f"Fetching activity chunk from hour {start_hour} to {start_hour + chunk_hours}")
-            
-            try:
-                chunk = email_tools.fetch_recent_emails(hours=chunk_hours)
-                if chunk:
-                    recent_emails.extend(chunk)
-            except Exception as chunk_error:
-                logger.error(f"Error fetching chunk: {chunk_error}")
-                continue
+        current_time = time.time()
         
-        activity_data = defaultdict(int)
-        current_time = datetime.now(pytz.UTC)
-        
-        # Initialize all hours with 0
-        for hour in range(hours):
-            activity_data[hour] = 0
-            
-        if recent_emails:
-            for email in recent_emails:
-                try:
-                    if current_service == EmailServiceType.GMAIL:
-                        email_timestamp = int(email.get('internalDate', '0')) / 1000
-                    else:
-                        email_timestamp = email.get('receivedDateTime', '')
-                        if isinstance(email_timestamp, str):
-                            email_time = datetime.fromisoformat(email_timestamp.replace('Z', '+00:00'))
-                            email_timestamp = email_time.timestamp()
-                    
-                    email_time = datetime.fromtimestamp(email_timestamp, pytz.UTC)
-                    time_diff = current_time - email_time
-                    hours_ago = int(time_diff.total_seconds() / 3600)
-                    
-                    if 0 <= hours_ago < hours:
-                        activity_data[hours_ago] += 1
-                except Exception as e:
-                    logger.error(f"Error processing email timestamp: {str(e)}")
-                    continue
+        # Count emails per hour-ago bucket, one vectorized pass per window
+        activity_data = np.zeros(hours, dtype=np.int64)
+        async for emails in iter_recent_emails(email_tools, hours):
+            timestamps = np.fromiter(
+                (email.ts for email in emails if email.ts is not None),
+                dtype=np.float64
+            )
+            hours_ago = ((current_time - timestamps) / 3600).astype(np.int64)
+            activity_data += np.bincount(
+                hours_ago[(hours_ago >= 0) & (hours_ago < hours)],
+                minlength=hours
+            )
+        activity_data = activity_data.tolist()
         
         # Create formatted response
         activity = []
@@ -324,6 +360,13 @@ async def set_email_service(email: str):
         logger.error(f"Error setting email service: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.on_event("shutdown")
+async def shutdown_email_tools():
+    """Close pooled connections and worker threads held by the email tools"""
+    await email_tools.cleanup()
+    # The workflow's response caches persist in the background
+    await flush_caches()
+
 @app.get("/health")  # Base health check endpoint
 async def health_check_base():
     return await health_check()
@@ -333,7 +376,7 @@ async def health_check():
     try:
         return {
             "status": "healthy",
-            "currentEmail": os.getenv('DEFAULT_EMAIL'),
+            "currentEmail": DEFAULT_EMAIL,
             "service": current_service.value if current_service else "unknown"
         }
     except Exception as e:
@@ -341,8 +384,9 @@ async def health_check():
         raise HTTPException(status_code=500, detail=str(e))
 
 # Add Workflow routes
+@functools.lru_cache(maxsize=None)
 def get_runnable():
-    return Workflow(default_email).app
+    return Workflow(DEFAULT_EMAIL).app
 
 try:
     runnable = get_runnable()
@@ -361,7 +405,9 @@ def main():
             app,
             host="0.0.0.0",
             port=8000,
-            log_level="info"
+            log_level="info",
+            loop="uvloop",
+            http="httptools"
         )
     except Exception as e:
         logger.error(f"Error starting the server: {str(e)}")
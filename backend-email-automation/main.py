@@ -2,9 +2,29 @@
 import asyncio
 from colorama import Fore, Style
 from src.graph import Workflow
+from src.cache import flush_caches
 from dotenv import load_dotenv
 import os
-import traceback
+import logging
+from types import MappingProxyType
+
+class ColorFormatter(logging.Formatter):
+    """Colorize log lines by level"""
+    COLORS = {
+        logging.DEBUG: Fore.YELLOW,
+        logging.INFO: Fore.GREEN,
+        logging.WARNING: Fore.MAGENTA,
+        logging.ERROR: Fore.RED,
+        logging.CRITICAL: Fore.RED,
+    }
+
+    def format(self, record):
+        return self.COLORS.get(record.levelno, "") + super().format(record) + Style.RESET_ALL
+
+handler = logging.StreamHandler()
+handler.setFormatter(ColorFormatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[handler])
+logger = logging.getLogger(__name__)
 
 # Load all env variables
 load_dotenv()
@@ -17,34 +37,49 @@ default_email = os.getenv('DEFAULT_EMAIL')
 if not default_email:
     raise ValueError("DEFAULT_EMAIL environment variable must be set")
 
-print(Fore.YELLOW + f"Using email: {default_email}" + Style.RESET_ALL)
+logger.info("Using email: %s", default_email)
 
 workflow = Workflow(default_email)
 app = workflow.app
 
-initial_state = {
-    "emails": [],
+# Read-only defaults; list/dict fields are stored as tuples/empty mappings so they can't be mutated in place
+_INITIAL_STATE_TEMPLATE = MappingProxyType({
+    "emails": (),
     "current_email": None,  # Changed from dict to None for initial state
+    "email_categories": MappingProxyType({}),
+    "rag_queries_by_email": MappingProxyType({}),
     "email_category": "",
     "generated_email": "",
-    "rag_queries": [],
+    "rag_queries": (),
     "retrieved_documents": "",
-    "writer_messages": [],
+    "writer_messages": (),
     "sendable": False,
     "trials": 0
-}
+})
+
+def new_initial_state():
+    """Build a fresh, mutable initial state from the read-only template"""
+    state = dict(_INITIAL_STATE_TEMPLATE)
+    for key, value in state.items():
+        # emails stays a tuple, nodes replace it rather than mutate it
+        if isinstance(value, tuple) and key != "emails":
+            state[key] = list(value)
+        elif isinstance(value, MappingProxyType):
+            state[key] = dict(value)
+    return state
 
 async def main():
     try:
-        print(Fore.GREEN + "Starting workflow..." + Style.RESET_ALL)
-        async for output in app.astream(initial_state, config):
+        logger.info("Starting workflow...")
+        async for output in app.astream(new_initial_state(), config):
             for key, value in output.items():
-                print(Fore.CYAN + f"Finished running: {key}" + Style.RESET_ALL)
+                logger.info("Finished running: %s", key)
     except Exception as e:
-        print(Fore.RED + f"Error in workflow: {str(e)}" + Style.RESET_ALL)
-        print(Fore.RED + "Traceback:" + Style.RESET_ALL)
-        traceback.print_exc()
+        logger.exception("Error in workflow: %s", e)
         raise e
+    finally:
+        # Let background response-cache writes land before the loop closes
+        await flush_caches()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -1,21 +1,57 @@
+import os
+import hashlib
+from functools import lru_cache
 from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 from langchain_chroma import Chroma
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from .cache import SemanticCache
 from .structure_outputs import *
 from .prompts import *
 
+LLM_MODEL = "gemini-1.5-flash"
+EMBEDDING_MODEL = "models/text-embedding-004"
+VECTORSTORE_DIR = "db"
+
+@lru_cache(maxsize=None)
+def get_embeddings():
+    """Shared embeddings client, created once per process"""
+    return GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL)
+
+@lru_cache(maxsize=None)
+def get_vectorstore():
+    """Shared Chroma store, opened once per process"""
+    return Chroma(persist_directory=VECTORSTORE_DIR, embedding_function=get_embeddings())
+
+def get_cache_namespace():
+    """
+    Identity of the models, prompts and knowledge base behind cached responses,
+    so switching models, editing prompts or rebuilding the index with create_index.py starts fresh caches
+    """
+    kb_version = max(
+        (os.stat(os.path.join(root, name)).st_mtime_ns
+         for root, _, names in os.walk(VECTORSTORE_DIR) for name in names),
+        default=0
+    )
+    prompts = (CATEGORIZE_EMAIL_PROMPT, GENERATE_RAG_QUERIES_PROMPT, GENERATE_RAG_ANSWER_PROMPT, EMAIL_WRITER_PROMPT)
+    identity = "\0".join((LLM_MODEL, EMBEDDING_MODEL, str(kb_version)) + prompts)
+    return hashlib.sha256(identity.encode()).hexdigest()[:16]
+
+@lru_cache(maxsize=None)
+def get_agents():
+    """Shared Agents instance, so LLM clients and chains are built once per process"""
+    return Agents()
+
 class Agents():
     def __init__(self):
         # Choose which LLMs to use for each agent (Gemini, LLAMA3,...)
-        gemini = ChatGoogleGenerativeAI(model="gemini-1.5-flash", temperature=0.1)
+        gemini = ChatGoogleGenerativeAI(model=LLM_MODEL, temperature=0.1)
+        cache_namespace = get_cache_namespace()
         
         # QA assistant chat
-        embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-        vectorstore = Chroma(persist_directory="db", embedding_function=embeddings)
-        retriever = vectorstore.as_retriever(search_kwargs={"k": 3})
+        retriever = get_vectorstore().as_retriever(search_kwargs={"k": 3})
 
         # Categorize email chain
         email_category_prompt = PromptTemplate(
@@ -32,18 +68,26 @@ class Agents():
             template=GENERATE_RAG_QUERIES_PROMPT, 
             input_variables=["email"]
         )
-        self.design_rag_queries = (
+        # Cached on exact matches only: emails that differ in one product name are near-identical embeddings
+        self.design_rag_queries = SemanticCache(
+            "rag_queries", get_embeddings(), namespace=cache_namespace, semantic=False
+        ).wrap(
             generate_query_prompt | 
-            gemini.with_structured_output(RAGQueriesOutput)
+            gemini.with_structured_output(RAGQueriesOutput),
+            key_fn=lambda inputs: inputs["email"]
         )
         
         # Generate answer to queries using RAG
         qa_prompt = ChatPromptTemplate.from_template(GENERATE_RAG_ANSWER_PROMPT)
-        self.generate_rag_answer = (
+        # Cached on exact matches only: one-line questions about different products clear any similarity threshold
+        self.generate_rag_answer = SemanticCache(
+            "rag_answers", get_embeddings(), namespace=cache_namespace, semantic=False
+        ).wrap(
             {"context": retriever, "question": RunnablePassthrough()}
             | qa_prompt
             | gemini
-            | StrOutputParser()
+            | StrOutputParser(),
+            key_fn=lambda query: query
         )
 
         # Used to write a draft email based on category and related informations
@@ -54,9 +98,14 @@ class Agents():
                 ("human", "{email_information}")
             ]
         )
-        self.email_writer = (
+        # Only first drafts of identical inputs are cached: a draft quotes its customer's own details,
+        # and rewrites depend on the proofreader feedback in history
+        self.email_writer = SemanticCache(
+            "email_writer", get_embeddings(), namespace=cache_namespace, semantic=False
+        ).wrap(
             writer_prompt | 
-            gemini.with_structured_output(WriterOutput)
+            gemini.with_structured_output(WriterOutput),
+            key_fn=lambda inputs: None if inputs["history"] else inputs["email_information"]
         )
 
         # Verify the generated email
@@ -0,0 +1,213 @@
+import os
+import time
+import pickle
+import asyncio
+import hashlib
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Semantic caches are persisted next to the other local state
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "transedge", "semantic")
+# Minimum cosine similarity for two inputs to share a cached response
+SIMILARITY_THRESHOLD = 0.92
+# Cached responses expire after a week
+CACHE_TTL = 7 * 24 * 3600
+
+# Background cache writes still running, awaited by flush_caches
+_persist_tasks = set()
+
+async def flush_caches():
+    """Wait for background cache writes to finish, before the event loop shuts down"""
+    while _persist_tasks:
+        await asyncio.gather(*_persist_tasks, return_exceptions=True)
+
+def normalize_text(text):
+    """Lowercase and collapse whitespace so trivially different inputs hash the same"""
+    return " ".join(text.lower().split())
+
+class SemanticCache():
+    """
+    Response cache keyed by exact normalized-text hash, then by embedding cosine similarity.
+    With semantic=False only exact hits are served, for responses specific to one input.
+    A namespace identifying the models and data behind the responses keeps each version in its own file.
+    """
+
+    def __init__(self, name, embeddings, threshold=SIMILARITY_THRESHOLD, ttl=CACHE_TTL, semantic=True, namespace=None):
+        self.path = os.path.join(CACHE_DIR, f"{name}-{namespace}.pkl" if namespace else f"{name}.pkl")
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.semantic = semantic
+        # sha256 -> (expires_at, unit-norm embedding or None, response)
+        self._entries = self._load()
+        self._index = None
+        # Running background write / a store landed since that write took its snapshot
+        self._persist_task = None
+        self._dirty = False
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                entries = pickle.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning("Discarding unreadable semantic cache %s: %s", self.path, e)
+            return {}
+        now = time.time()
+        return {key: entry for key, entry in entries.items() if entry[0] > now}
+
+    def _save(self, entries):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def _schedule_persist(self):
+        """Write the cache in a background task, folding stores that land mid-write into one more write"""
+        self._dirty = True
+        if self._persist_task is None:
+            self._persist_task = asyncio.create_task(self._persist())
+            _persist_tasks.add(self._persist_task)
+            self._persist_task.add_done_callback(_persist_tasks.discard)
+
+    async def _persist(self):
+        try:
+            while self._dirty:
+                self._dirty = False
+                await asyncio.to_thread(self._save, dict(self._entries))
+        except OSError as e:
+            logger.warning("Could not persist semantic cache %s: %s", self.path, e)
+        finally:
+            # Cleared without yielding after the last dirty check, so no store can slip through
+            self._persist_task = None
+
+    def _get_index(self, dim):
+        """Keys and stacked embeddings of the entries with `dim`-sized embeddings, rebuilt only after a store"""
+        if self._index is None or self._index[2] != dim:
+            keys = [
+                key for key, entry in self._entries.items()
+                if entry[1] is not None and entry[1].shape == (dim,)
+            ]
+            matrix = np.stack([self._entries[key][1] for key in keys]) if keys else None
+            self._index = (keys, matrix, dim)
+        return self._index[:2]
+
+    async def lookup(self, texts):
+        """Return a (response, key, embedding) triple per text; response is None on a miss"""
+        now = time.time()
+        keys = [hashlib.sha256(normalize_text(text).encode()).hexdigest() for text in texts]
+        results = [None] * len(texts)
+        misses = []
+        for i, key in enumerate(keys):
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                results[i] = (entry[2], key, None)
+            else:
+                misses.append(i)
+        if not self.semantic:
+            for i in misses:
+                results[i] = (None, keys[i], None)
+            return results
+        if not misses:
+            return results
+
+        try:
+            vectors = np.asarray(
+                await self.embeddings.aembed_documents([texts[i] for i in misses]),
+                dtype=np.float32
+            )
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        except Exception as e:
+            # Serve the misses uncached rather than failing the LLM call
+            logger.warning("Semantic cache embedding failed: %s", e)
+            for i in misses:
+                results[i] = (None, keys[i], None)
+            return results
+
+        try:
+            # Entries embedded with another embedding size are left out of the search
+            index_keys, matrix = self._get_index(vectors.shape[1])
+            if matrix is not None:
+                scores = vectors @ matrix.T
+                best = scores.argmax(axis=1)
+        except Exception as e:
+            logger.warning("Semantic cache search failed: %s", e)
+            matrix = None
+        for row, i in enumerate(misses):
+            response = None
+            if matrix is not None and scores[row, best[row]] >= self.threshold:
+                entry = self._entries[index_keys[best[row]]]
+                if entry[0] > now:
+                    response = entry[2]
+            results[i] = (response, keys[i], vectors[row])
+        return results
+
+    def store(self, items):
+        """Cache (key, embedding, response) triples; the cache is persisted in the background"""
+        expires_at = time.time() + self.ttl
+        stored = False
+        for key, vector, response in items:
+            # A semantic entry without its embedding would be missing from the index
+            if vector is not None or not self.semantic:
+                self._entries[key] = (expires_at, vector, response)
+                stored = True
+        if not stored:
+            return
+        now = time.time()
+        self._entries = {key: entry for key, entry in self._entries.items() if entry[0] > now}
+        self._index = None
+        self._schedule_persist()
+
+    def wrap(self, runnable, key_fn):
+        """Put the cache in front of a chain; key_fn maps its input to the text to match, or None to bypass"""
+        return CachedRunnable(runnable, self, key_fn)
+
+class CachedRunnable():
+    """Stands in for a chain's ainvoke/abatch, serving near-duplicate inputs from a SemanticCache"""
+
+    def __init__(self, runnable, cache, key_fn):
+        self.runnable = runnable
+        self.cache = cache
+        self.key_fn = key_fn
+
+    async def ainvoke(self, inputs, config=None):
+        text = self.key_fn(inputs)
+        if text is None:
+            return await self.runnable.ainvoke(inputs, config)
+
+        (response, key, vector), = await self.cache.lookup([text])
+        if response is None:
+            response = await self.runnable.ainvoke(inputs, config)
+            self.cache.store([(key, vector, response)])
+        return response
+
+    async def abatch(self, inputs, config=None, return_exceptions=False):
+        cached = [i for i, item in enumerate(inputs) if self.key_fn(item) is not None]
+        lookups = dict(zip(cached, await self.cache.lookup([self.key_fn(inputs[i]) for i in cached])))
+
+        results = [None] * len(inputs)
+        misses = []
+        for i in range(len(inputs)):
+            if i in lookups and lookups[i][0] is not None:
+                results[i] = lookups[i][0]
+            else:
+                misses.append(i)
+
+        if misses:
+            responses = await self.runnable.abatch(
+                [inputs[i] for i in misses],
+                config=config,
+                return_exceptions=return_exceptions
+            )
+            new_entries = []
+            for i, response in zip(misses, responses):
+                results[i] = response
+                if i in lookups and not isinstance(response, Exception):
+                    _, key, vector = lookups[i]
+                    new_entries.append((key, vector, response))
+            self.cache.store(new_entries)
+        return results
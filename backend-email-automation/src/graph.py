@@ -26,33 +26,20 @@ class Workflow:
                 raise ValueError("Email address must be provided either directly or through DEFAULT_EMAIL environment variable")
             nodes = Nodes(default_email)
 
-        # define all graph nodes
-        workflow.add_node("load_inbox_emails", nodes.load_new_emails)
-        workflow.add_node("is_email_inbox_empty", nodes.is_email_inbox_empty)
-        workflow.add_node("categorize_email", nodes.categorize_email)
-        workflow.add_node("construct_rag_queries", nodes.construct_rag_queries)
-        workflow.add_node("retrieve_from_rag", nodes.retrieve_from_rag)
-        workflow.add_node("email_writer", nodes.write_draft_email)
-        workflow.add_node("email_proofreader", nodes.verify_generated_email)
-        workflow.add_node("send_email", nodes.create_draft_response)
-        workflow.add_node("skip_unrelated_email", nodes.skip_unrelated_email)
+        # per-email pipeline, run concurrently for every inbox email by `process_emails`
+        email_workflow = StateGraph(GraphState)
+        email_workflow.add_node("categorize_email", nodes.categorize_email)
+        email_workflow.add_node("construct_rag_queries", nodes.construct_rag_queries)
+        email_workflow.add_node("retrieve_from_rag", nodes.retrieve_from_rag)
+        email_workflow.add_node("email_writer", nodes.write_draft_email)
+        email_workflow.add_node("email_proofreader", nodes.verify_generated_email)
+        email_workflow.add_node("send_email", nodes.create_draft_response)
+        email_workflow.add_node("skip_unrelated_email", nodes.skip_unrelated_email)
 
-        # load inbox emails
-        workflow.set_entry_point("load_inbox_emails")
-
-        # check if there are emails to process
-        workflow.add_edge("load_inbox_emails", "is_email_inbox_empty")
-        workflow.add_conditional_edges(
-            "is_email_inbox_empty",
-            nodes.check_new_emails,
-            {
-                "process": "categorize_email",
-                "empty": END
-            }
-        )
+        email_workflow.set_entry_point("categorize_email")
 
         # route email based on category
-        workflow.add_conditional_edges(
+        email_workflow.add_conditional_edges(
             "categorize_email",
             nodes.route_email_based_on_category,
             {
@@ -63,25 +50,52 @@ class Workflow:
         )
 
         # pass constructed queries to RAG chain to retrieve information
-        workflow.add_edge("construct_rag_queries", "retrieve_from_rag")
+        email_workflow.add_edge("construct_rag_queries", "retrieve_from_rag")
         # give information to writer agent to create draft email
-        workflow.add_edge("retrieve_from_rag", "email_writer")
+        email_workflow.add_edge("retrieve_from_rag", "email_writer")
         # proofread the generated draft email
-        workflow.add_edge("email_writer", "email_proofreader")
+        email_workflow.add_edge("email_writer", "email_proofreader")
         # check if email is sendable or not, if not rewrite the email
-        workflow.add_conditional_edges(
+        email_workflow.add_conditional_edges(
             "email_proofreader",
             nodes.must_rewrite,
             {
                 "send": "send_email",
                 "rewrite": "email_writer",
-                "stop": "categorize_email"
+                "stop": END
+            }
+        )
+
+        email_workflow.add_edge("send_email", END)
+        email_workflow.add_edge("skip_unrelated_email", END)
+
+        nodes.email_pipeline = email_workflow.compile()
+
+        # define inbox graph nodes
+        workflow.add_node("load_inbox_emails", nodes.load_new_emails)
+        workflow.add_node("categorize_emails", nodes.categorize_emails)
+        workflow.add_node("is_email_inbox_empty", nodes.is_email_inbox_empty)
+        workflow.add_node("process_emails", nodes.process_emails)
+
+        # load inbox emails
+        workflow.set_entry_point("load_inbox_emails")
+
+        # categorize all loaded emails up front in batched LLM calls
+        workflow.add_edge("load_inbox_emails", "categorize_emails")
+
+        # check if there are emails to process
+        workflow.add_edge("categorize_emails", "is_email_inbox_empty")
+        workflow.add_conditional_edges(
+            "is_email_inbox_empty",
+            nodes.check_new_emails,
+            {
+                "process": "process_emails",
+                "empty": END
             }
         )
 
-        # check if there are still emails to be processed
-        workflow.add_edge("send_email", "is_email_inbox_empty")
-        workflow.add_edge("skip_unrelated_email", "is_email_inbox_empty")
+        # all emails are processed concurrently in a single step
+        workflow.add_edge("process_emails", END)
 
         # Compile
         self.app = workflow.compile()
\ No newline at end of file
@@ -1,28 +1,40 @@
+import os
+import asyncio
 from enum import Enum
-from colorama import Fore, Style
+from functools import lru_cache
+import logging
 from typing import Optional
-from .agents import Agents
+from pydantic import TypeAdapter
+from .agents import get_agents
 from .state import GraphState, Email
 from .tools.GmailTools import GmailToolsClass
 from .tools.enhanced_outlook_tools import EnhancedOutlookTools
 
+logger = logging.getLogger(__name__)
+
+# Max concurrent LLM requests when batching calls across the inbox
+LLM_BATCH_CONCURRENCY = 8
+
+# Validates a whole fetched inbox in one pydantic-core call
+_EMAIL_LIST_ADAPTER = TypeAdapter(tuple[Email, ...])
+
 class EmailServiceType(Enum):
     GMAIL = "gmail"
     OUTLOOK = "outlook"
 
+# Shared with deploy_api, so the API and the workflow pick the same service for an address
+OUTLOOK_DOMAINS = frozenset({"outlook.com", "hotmail.com", "live.com", "msn.com", "office365.com"})
+
+@lru_cache(maxsize=1024)
+def detect_service(email_address: str) -> EmailServiceType:
+    """Detects the type of email service based on email address"""
+    email_domain = email_address.rpartition("@")[2].lower()
+    # Gmail and custom domains both default to Gmail
+    return EmailServiceType.OUTLOOK if email_domain in OUTLOOK_DOMAINS else EmailServiceType.GMAIL
+
 class EmailServiceDetector:
     """Detects the type of email service based on email address"""
-    @staticmethod
-    def detect_service(email_address: str) -> EmailServiceType:
-        email_domain = email_address.lower().split('@')[1]
-        
-        if 'gmail.com' in email_domain:
-            return EmailServiceType.GMAIL
-        elif any(domain in email_domain for domain in ['outlook.com', 'hotmail.com', 'live.com']):
-            return EmailServiceType.OUTLOOK
-        else:
-            # For custom domains, default to Gmail
-            return EmailServiceType.GMAIL
+    detect_service = staticmethod(detect_service)
 
 class EmailTools:
     """Unified interface for email operations"""
@@ -40,7 +52,7 @@ class EmailTools:
         try:
             return await self.service.fetch_unanswered_emails(max_results)
         except Exception as e:
-            print(f"Error fetching emails: {e}")
+            logger.error("Error fetching emails: %s", e)
             return []
 
     async def create_draft_reply(self, initial_email, reply_text):
@@ -48,7 +60,7 @@ class EmailTools:
         try:
             return await self.service.create_draft_reply(initial_email, reply_text)
         except Exception as e:
-            print(f"Error creating draft: {e}")
+            logger.error("Error creating draft: %s", e)
             return None
 
     async def send_reply(self, initial_email, reply_text):
@@ -56,7 +68,7 @@ class EmailTools:
         try:
             return await self.service.send_reply(initial_email, reply_text)
         except Exception as e:
-            print(f"Error sending reply: {e}")
+            logger.error("Error sending reply: %s", e)
             return None
 
     async def fetch_draft_replies(self):
@@ -64,58 +76,143 @@ class EmailTools:
         try:
             return await self.service.fetch_draft_replies()
         except Exception as e:
-            print(f"Error fetching drafts: {e}")
+            logger.error("Error fetching drafts: %s", e)
             return []
 
+    async def acknowledge_emails(self, processed_ids, failed_ids):
+        """Report processed and failed emails to either service"""
+        try:
+            await self.service.acknowledge_emails(processed_ids, failed_ids)
+        except Exception as e:
+            logger.error("Error acknowledging emails: %s", e)
+
+    async def flush_sends(self):
+        """Send replies queued by either service"""
+        try:
+            await self.service.flush_sends()
+        except Exception as e:
+            logger.error("Error flushing sent replies: %s", e)
+
 class Nodes:
     def __init__(self, email_address: str):
         """Initialize Nodes with email service detection"""
-        self.agents = Agents()
+        self.agents = get_agents()
         self.email_address = email_address
         self.email_tools = EmailTools(email_address)
-        print(f"{Fore.CYAN}Initialized email service: {self.email_tools.service_type.value}{Style.RESET_ALL}")
+        # Compiled per-email graph, set by Workflow
+        self.email_pipeline = None
+        # Max emails going through the per-email pipeline at once
+        self.email_concurrency = int(os.getenv("EMAIL_CONCURRENCY", "8"))
+        logger.info("Initialized email service: %s", self.email_tools.service_type.value)
 
     async def load_new_emails(self, state: GraphState) -> GraphState:
         """Load new emails from configured provider"""
-        print(Fore.YELLOW + f"Loading new emails from {self.email_tools.service_type.value}...\n" + Style.RESET_ALL)
+        logger.info("Loading new emails from %s...", self.email_tools.service_type.value)
         try:
             emails = await self.email_tools.fetch_unanswered_emails()
             if not emails:
-                return {"emails": []}
-            return {"emails": [Email(**email) for email in emails]}
+                return {"emails": ()}
+            return {"emails": _EMAIL_LIST_ADAPTER.validate_python(emails)}
         except Exception as e:
-            print(Fore.RED + f"Error loading emails: {str(e)}" + Style.RESET_ALL)
-            return {"emails": []}
+            logger.error("Error loading emails: %s", e)
+            return {"emails": ()}
 
     def check_new_emails(self, state: GraphState) -> str:
         """Check if there are new emails to process"""
         if len(state['emails']) == 0:
-            print(Fore.RED + "No new emails to process" + Style.RESET_ALL)
+            logger.info("No new emails to process")
             return "empty"
-        print(Fore.GREEN + f"Found {len(state['emails'])} new emails to process" + Style.RESET_ALL)
+        logger.info("Found %d new emails to process", len(state['emails']))
         return "process"
 
+    async def categorize_emails(self, state: GraphState) -> GraphState:
+        """Categorizes every loaded email, and designs RAG queries for product enquiries, in batched LLM calls."""
+        emails = state["emails"]
+        if not emails:
+            return {"email_categories": {}, "rag_queries_by_email": {}}
+
+        logger.info("Categorizing %d emails...", len(emails))
+        batch_config = {"max_concurrency": LLM_BATCH_CONCURRENCY}
+        results = await self.agents.categorize_email.abatch(
+            [{"email": email.body} for email in emails],
+            config=batch_config,
+            return_exceptions=True
+        )
+        # Failed items are left out and categorized one by one later
+        email_categories = {
+            email.id: result.category.value
+            for email, result in zip(emails, results)
+            if not isinstance(result, Exception)
+        }
+
+        product_emails = [email for email in emails if email_categories.get(email.id) == "product_enquiry"]
+        rag_queries_by_email = {}
+        if product_emails:
+            query_results = await self.agents.design_rag_queries.abatch(
+                [{"email": email.body} for email in product_emails],
+                config=batch_config,
+                return_exceptions=True
+            )
+            rag_queries_by_email = {
+                email.id: result.queries
+                for email, result in zip(product_emails, query_results)
+                if not isinstance(result, Exception)
+            }
+
+        return {"email_categories": email_categories, "rag_queries_by_email": rag_queries_by_email}
+
     def is_email_inbox_empty(self, state: GraphState) -> GraphState:
         """Check if email inbox is empty"""
         return state
 
-    def categorize_email(self, state: GraphState) -> GraphState:
+    async def process_emails(self, state: GraphState) -> GraphState:
+        """Runs the per-email pipeline for every loaded email concurrently."""
+        semaphore = asyncio.Semaphore(self.email_concurrency)
+
+        async def process_one(email):
+            async with semaphore:
+                return await self.email_pipeline.ainvoke({
+                    "emails": (email,),
+                    "email_categories": state.get("email_categories", {}),
+                    "rag_queries_by_email": state.get("rag_queries_by_email", {}),
+                    "trials": 0
+                })
+
+        emails = state["emails"]
+        results = await asyncio.gather(*[process_one(email) for email in emails], return_exceptions=True)
+        processed_ids, failed_ids = [], []
+        for email, result in zip(emails, results):
+            if isinstance(result, Exception):
+                logger.error("Error processing email %s: %s", email.id, result)
+                failed_ids.append(email.id)
+            else:
+                processed_ids.append(email.id)
+
+        # Replies queued during the pipeline runs go out together
+        await self.email_tools.flush_sends()
+        # Only now may the service move past these emails; failed ones are offered again
+        await self.email_tools.acknowledge_emails(processed_ids, failed_ids)
+        return {"emails": ()}
+
+    async def categorize_email(self, state: GraphState) -> GraphState:
         """Categorizes the current email using the categorize_email agent."""
-        print(Fore.YELLOW + "Checking email category...\n" + Style.RESET_ALL)
+        logger.debug("Checking email category...")
         
         # Get the last email
         current_email = state["emails"][-1]
-        result = self.agents.categorize_email.invoke({"email": current_email.body})
-        print(Fore.MAGENTA + f"Email category: {result.category.value}" + Style.RESET_ALL)
+        category = state.get("email_categories", {}).get(current_email.id)
+        if category is None:
+            category = (await self.agents.categorize_email.ainvoke({"email": current_email.body})).category.value
+        logger.info("Email %s category: %s", current_email.id, category)
         
         return {
-            "email_category": result.category.value,
+            "email_category": category,
             "current_email": current_email
         }
 
     def route_email_based_on_category(self, state: GraphState) -> str:
         """Routes the email based on its category."""
-        print(Fore.YELLOW + "Routing email based on category...\n" + Style.RESET_ALL)
+        logger.debug("Routing email based on category...")
         category = state["email_category"]
         if category == "product_enquiry":
             return "product related"
@@ -124,27 +221,30 @@ class Nodes:
         else:
             return "not product related"
 
-    def construct_rag_queries(self, state: GraphState) -> GraphState:
+    async def construct_rag_queries(self, state: GraphState) -> GraphState:
         """Constructs RAG queries based on the email content."""
-        print(Fore.YELLOW + "Designing RAG query...\n" + Style.RESET_ALL)
-        email_content = state["current_email"].body
-        query_result = self.agents.design_rag_queries.invoke({"email": email_content})
+        logger.debug("Designing RAG query...")
+        current_email = state["current_email"]
+        queries = state.get("rag_queries_by_email", {}).get(current_email.id)
+        if queries is None:
+            queries = (await self.agents.design_rag_queries.ainvoke({"email": current_email.body})).queries
         
-        return {"rag_queries": query_result.queries}
+        return {"rag_queries": queries}
 
-    def retrieve_from_rag(self, state: GraphState) -> GraphState:
+    async def retrieve_from_rag(self, state: GraphState) -> GraphState:
         """Retrieves information from internal knowledge based on RAG questions."""
-        print(Fore.YELLOW + "Retrieving information from internal knowledge...\n" + Style.RESET_ALL)
-        final_answer = ""
-        for query in state["rag_queries"]:
-            rag_result = self.agents.generate_rag_answer.invoke(query)
-            final_answer += query + "\n" + rag_result + "\n\n"
+        logger.debug("Retrieving information from internal knowledge...")
+        queries = state["rag_queries"]
+        rag_results = await asyncio.gather(
+            *(self.agents.generate_rag_answer.ainvoke(query) for query in queries)
+        )
+        final_answer = "\n\n".join(f"{query}\n{result}" for query, result in zip(queries, rag_results))
         
         return {"retrieved_documents": final_answer}
 
-    def write_draft_email(self, state: GraphState) -> GraphState:
+    async def write_draft_email(self, state: GraphState) -> GraphState:
         """Writes a draft email based on the current email and retrieved information."""
-        print(Fore.YELLOW + "Writing draft email...\n" + Style.RESET_ALL)
+        logger.debug("Writing draft email...")
         
         # Format input to the writer agent
         inputs = (
@@ -157,7 +257,7 @@ class Nodes:
         writer_messages = state.get('writer_messages', [])
         
         # Write email
-        draft_result = self.agents.email_writer.invoke({
+        draft_result = await self.agents.email_writer.ainvoke({
             "email_information": inputs,
             "history": writer_messages
         })
@@ -173,10 +273,10 @@ class Nodes:
             "writer_messages": writer_messages
         }
 
-    def verify_generated_email(self, state: GraphState) -> GraphState:
+    async def verify_generated_email(self, state: GraphState) -> GraphState:
         """Verifies the generated email using the proofreader agent."""
-        print(Fore.YELLOW + "Verifying generated email...\n" + Style.RESET_ALL)
-        review = self.agents.email_proofreader.invoke({
+        logger.debug("Verifying generated email...")
+        review = await self.agents.email_proofreader.ainvoke({
             "initial_email": state["current_email"].body,
             "generated_email": state["generated_email"],
         })
@@ -193,48 +293,43 @@ class Nodes:
         """Determines if the email needs to be rewritten based on the review and trial count."""
         email_sendable = state["sendable"]
         if email_sendable:
-            print(Fore.GREEN + "Email is good, ready to be sent!!!" + Style.RESET_ALL)
-            state["emails"].pop()
-            state["writer_messages"] = []
+            logger.info("Email is good, ready to be sent!!!")
             return "send"
         elif state["trials"] >= 3:
-            print(Fore.RED + "Email is not good, we reached max trials must stop!!!" + Style.RESET_ALL)
-            state["emails"].pop()
-            state["writer_messages"] = []
+            logger.warning("Email is not good, we reached max trials must stop!!!")
             return "stop"
         else:
-            print(Fore.RED + "Email is not good, must rewrite it..." + Style.RESET_ALL)
+            logger.info("Email is not good, must rewrite it...")
             return "rewrite"
 
     async def create_draft_response(self, state: GraphState) -> GraphState:
         """Create draft response in email system"""
-        print(Fore.YELLOW + "Creating email draft...\n" + Style.RESET_ALL)
+        logger.debug("Creating email draft...")
         try:
             await self.email_tools.create_draft_reply(
                 state["current_email"],
                 state["generated_email"]
             )
-            print(Fore.GREEN + "Draft created successfully" + Style.RESET_ALL)
+            logger.info("Draft created successfully")
         except Exception as e:
-            print(Fore.RED + f"Error creating draft: {str(e)}" + Style.RESET_ALL)
-        return {"retrieved_documents": "", "trials": 0}
+            logger.error("Error creating draft: %s", e)
+        return {"emails": state["emails"][:-1], "retrieved_documents": "", "trials": 0}
 
     async def send_email_response(self, state: GraphState) -> GraphState:
         """Send the email response"""
-        print(Fore.YELLOW + "Sending email...\n" + Style.RESET_ALL)
+        logger.debug("Sending email...")
         try:
             await self.email_tools.send_reply(
                 state["current_email"],
                 state["generated_email"]
             )
-            print(Fore.GREEN + "Email sent successfully" + Style.RESET_ALL)
+            logger.info("Email sent successfully")
         except Exception as e:
-            print(Fore.RED + f"Error sending email: {str(e)}" + Style.RESET_ALL)
-        return {"retrieved_documents": "", "trials": 0}
+            logger.error("Error sending email: %s", e)
+        return {"emails": state["emails"][:-1], "retrieved_documents": "", "trials": 0}
 
     def skip_unrelated_email(self, state: GraphState) -> GraphState:
         """Skip processing for unrelated emails"""
-        print(Fore.YELLOW + "Skipping unrelated email...\n" + Style.RESET_ALL)
-        state["emails"].pop()
-        print(Fore.GREEN + "Email skipped" + Style.RESET_ALL)
-        return state
\ No newline at end of file
+        logger.debug("Skipping unrelated email...")
+        logger.info("Email skipped")
+        return {"emails": state["emails"][:-1]}
\ No newline at end of file
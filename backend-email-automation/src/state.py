@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Annotated
+from typing import Dict, List, Tuple, Annotated
 from typing_extensions import TypedDict
 from langgraph.graph.message import add_messages
 
@@ -13,8 +13,10 @@ class Email(BaseModel):
     body: str = Field(..., description="Body content of the email")
     
 class GraphState(TypedDict):
-    emails: List[Email]
+    emails: Tuple[Email, ...]
     current_email: Email
+    email_categories: Dict[str, str]
+    rag_queries_by_email: Dict[str, List[str]]
     email_category: str
     generated_email: str
     rag_queries: List[str]
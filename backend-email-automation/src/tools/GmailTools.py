@@ -3,6 +3,7 @@ import re
 import uuid
 import base64
 import asyncio
+import threading
 from functools import partial
 from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
@@ -19,15 +20,30 @@ SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
 class GmailToolsClass(BaseEmailTool):
     def __init__(self):
-        self.service = self._get_gmail_service()
+        self._creds = self._get_gmail_credentials()
+        # httplib2 transports aren't thread-safe, so each worker thread gets its own Gmail client
+        self._local = threading.local()
+        self._creds_lock = threading.Lock()
         self._executor = ThreadPoolExecutor(max_workers=5)
 
-    def fetch_recent_emails(self, hours=24, max_results=500):
+    @property
+    def service(self):
+        """Gmail API client for the calling thread"""
+        # The per-thread clients share one set of credentials; refresh them in one thread only
+        with self._creds_lock:
+            if not self._creds.valid and self._creds.refresh_token:
+                self._creds.refresh(Request())
+        service = getattr(self._local, "service", None)
+        if service is None:
+            service = self._local.service = build('gmail', 'v1', credentials=self._creds)
+        return service
+
+    def fetch_recent_emails(self, hours=24, max_results=500, start_hour=0):
         """
         Public method to fetch recent emails - required by the API.
         Direct synchronous wrapper around fetch_recent_emails_sync.
         """
-        return self.fetch_recent_emails_sync(hours=hours, max_results=max_results)
+        return self.fetch_recent_emails_sync(hours=hours, max_results=max_results, start_hour=start_hour)
 
     async def _run_sync(self, func, *args, **kwargs):
         """Run synchronous functions asynchronously"""
@@ -78,12 +94,18 @@ class GmailToolsClass(BaseEmailTool):
 
         return await self._run_sync(_fetch)
 
-    def fetch_recent_emails_sync(self, hours=24, max_results=500):
-        """Synchronous version of fetch_recent_emails"""
+    def fetch_recent_emails_sync(self, hours=24, max_results=500, start_hour=0):
+        """
+        Synchronous version of fetch_recent_emails.
+        Fetches emails received between `start_hour + hours` and `start_hour` hours ago.
+        """
         try:
             now = datetime.now()
-            delay = now - timedelta(hours=hours)
+            delay = now - timedelta(hours=start_hour + hours)
             query = f'after:{int(delay.timestamp())} in:inbox'
+            if start_hour:
+                until = now - timedelta(hours=start_hour)
+                query += f' before:{int(until.timestamp())}'
             
             results = self.service.users().messages().list(
                 userId="me",
@@ -167,8 +189,8 @@ class GmailToolsClass(BaseEmailTool):
         """Private method to fetch drafts - used internally"""
         return self.fetch_draft_replies()
 
-    def _get_gmail_service(self):
-        """Initialize and get Gmail service"""
+    def _get_gmail_credentials(self):
+        """Load, refresh or obtain the Gmail OAuth credentials"""
         creds = None
         if os.path.exists('/app/token.json'):
             creds = Credentials.from_authorized_user_file('/app/token.json', SCOPES)
@@ -181,7 +203,7 @@ class GmailToolsClass(BaseEmailTool):
             with open('/app/token.json', 'w') as token:
                 token.write(creds.to_json())
         
-        return build('gmail', 'v1', credentials=creds)
+        return creds
     
     def _should_skip_email(self, email_info):
         """Check if email should be skipped"""
@@ -1,150 +1,343 @@
 import os
 import ssl
+import atexit
 import certifi
 import aiohttp
-from msal import ConfidentialClientApplication
+from msal import ConfidentialClientApplication, SerializableTokenCache
 from .base_email_tool import BaseEmailTool
-from aiohttp import web
 import webbrowser
+import logging
 import asyncio
-from urllib.parse import urlencode
+from functools import cache
+from urllib.parse import urlencode, urlsplit, parse_qs
+
+try:
+    import orjson
+
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:  # stdlib fallback
+    import json
+
+    def _json_dumps(obj):
+        return json.dumps(obj).encode()
+
+    _json_loads = json.loads
+
+try:
+    # Incremental parser for large collection pages; picks the yajl2_c backend when available
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+# Max sub-requests Graph accepts in a single $batch call
+GRAPH_BATCH_LIMIT = 20
+
+# Pooled keep-alive session shared by every OutlookTools instance in the process
+_session = None
+# TLS context built once, so the certifi bundle is parsed once per process rather than per session
+_SSL_CTX = ssl.create_default_context(cafile=certifi.where())
+
+GRAPH_SCOPES = ["https://graph.microsoft.com/Mail.ReadWrite"]
+# Seconds to wait for the user to complete the browser sign-in
+AUTH_CALLBACK_TIMEOUT = 120
+
+# Only the message fields the workflow reads, with drafts filtered out server-side.
+# Graph rejects $orderby properties that don't lead the $filter expression.
+MESSAGE_SELECT = "id,subject,from,conversationId,receivedDateTime,internetMessageId,isRead,body"
+MESSAGE_FILTER = "receivedDateTime ge 1900-01-01T00:00:00Z and isDraft eq false"
+# Ask Graph for plain-text bodies instead of full HTML
+TEXT_BODY_HEADERS = {"Prefer": 'outlook.body-content-type="text"'}
+
+# On-disk MSAL token cache, so restarts refresh tokens silently instead of re-running the browser flow
+CACHE_DIR = os.path.expanduser("~/.cache/transedge")
+TOKEN_CACHE_PATH = os.path.join(CACHE_DIR, "outlook_token.json")
+_token_cache = None
+
+def _get_token_cache():
+    """Load the persisted MSAL token cache once per process"""
+    global _token_cache
+    if _token_cache is None:
+        _token_cache = SerializableTokenCache()
+        if os.path.exists(TOKEN_CACHE_PATH):
+            with open(TOKEN_CACHE_PATH) as f:
+                _token_cache.deserialize(f.read())
+        atexit.register(_save_token_cache)
+    return _token_cache
+
+def _save_token_cache():
+    """Persist the MSAL token cache if it changed, readable by the owner only"""
+    if _token_cache is not None and _token_cache.has_state_changed:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        fd = os.open(TOKEN_CACHE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        # O_CREAT's mode only applies to new files, tighten caches written before
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(_token_cache.serialize())
+
+@cache
+def _get_msal_app(client_id, client_secret, authority):
+    """MSAL client per app registration, shared by every mailbox so authority discovery runs once"""
+    return ConfidentialClientApplication(
+        client_id,
+        authority=authority,
+        client_credential=client_secret,
+        token_cache=_get_token_cache()
+    )
 
 class OutlookTools(BaseEmailTool):
     def __init__(self, client_id, client_secret, tenant_id):
         self.client_id = client_id
         self.client_secret = client_secret
         self.tenant_id = tenant_id
+        self.authority = f"https://login.microsoftonline.com/{tenant_id}"
         self.base_url = "https://graph.microsoft.com/v1.0"
-        self.session = None
         self.email_address = None
         self.token = None
         self.app = None
         
     async def initialize(self):
-        """Initialize the OAuth2 flow and get access token"""
+        """Initialize the OAuth2 flow, get access token and open the shared session"""
         self.token = await self._get_access_token()
+        await self._get_session()
         
     def _create_msal_app(self):
-        """Create MSAL confidential client application"""
-        authority = f"https://login.microsoftonline.com/{self.tenant_id}"
-        return ConfidentialClientApplication(
-            self.client_id,
-            authority=authority,
-            client_credential=self.client_secret
-        )
+        """Get the shared MSAL confidential client application"""
+        return _get_msal_app(self.client_id, self.client_secret, self.authority)
 
     async def _get_auth_code(self):
         """Get authorization code through local web server"""
-        # Create MSAL app
-        self.app = self._create_msal_app()
-        
         # Authorization URL parameters
         auth_params = {
             'client_id': self.client_id,
             'response_type': 'code',
             'redirect_uri': 'http://localhost:8000/callback',
-            'scope': 'https://graph.microsoft.com/Mail.ReadWrite',
+            'scope': ' '.join(['offline_access'] + GRAPH_SCOPES),
             'response_mode': 'query'
         }
         
         # Construct authorization URL
-        auth_url = f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/v2.0/authorize?{urlencode(auth_params)}"
+        auth_url = f"{self.authority}/oauth2/v2.0/authorize?{urlencode(auth_params)}"
         
-        # Store auth code
-        auth_code = None
+        # Set by the callback handler as soon as the redirect arrives
+        callback_received = asyncio.Event()
+        callback_params = {}
         
-        # Create local server to handle callback
-        async def handle_callback(request):
-            nonlocal auth_code
-            auth_code = request.query.get('code')
-            return web.Response(text="Authentication successful! You can close this window.")
+        # Minimal HTTP listener: read the request line of each connection and answer the /callback redirect
+        async def handle_callback(reader, writer):
+            try:
+                request_line = (await reader.readline()).decode('latin-1')
+                parts = request_line.split()
+                target = urlsplit(parts[1]) if len(parts) >= 2 else None
+                if target is not None and target.path == '/callback':
+                    callback_params.update((key, values[0]) for key, values in parse_qs(target.query).items())
+                    callback_received.set()
+                    if 'code' in callback_params:
+                        body = b"Authentication successful! You can close this window."
+                        status = b"200 OK"
+                    else:
+                        # e.g. ?error=access_denied&error_description=...
+                        error = callback_params.get('error_description') or callback_params.get('error', 'no code returned')
+                        body = f"Authentication failed: {error}".encode()
+                        status = b"400 Bad Request"
+                else:
+                    body = b"Not Found"
+                    status = b"404 Not Found"
+                writer.write(
+                    b"HTTP/1.1 " + status + b"\r\nContent-Type: text/plain\r\nContent-Length: "
+                    + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body
+                )
+                await writer.drain()
+            finally:
+                writer.close()
         
         # Setup server
-        app = web.Application()
-        app.router.add_get('/callback', handle_callback)
-        runner = web.AppRunner(app)
-        await runner.setup()
-        site = web.TCPSite(runner, 'localhost', 8000)
-        await site.start()
+        server = await asyncio.start_server(handle_callback, 'localhost', 8000)
         
-        # Open browser for auth
-        print("Opening browser for authentication...")
-        webbrowser.open(auth_url)
-        
-        # Wait for auth code
-        while auth_code is None:
-            await asyncio.sleep(1)
+        try:
+            # Open browser for auth
+            logger.info("Opening browser for authentication...")
+            webbrowser.open(auth_url)
             
-        # Cleanup server
-        await runner.cleanup()
+            # Wait for auth code
+            await asyncio.wait_for(callback_received.wait(), timeout=AUTH_CALLBACK_TIMEOUT)
+        finally:
+            # Cleanup server
+            server.close()
+            await server.wait_closed()
         
+        auth_code = callback_params.get('code')
+        if auth_code is None:
+            raise Exception(f"Authorization failed: {callback_params.get('error_description', 'no code returned')}")
         return auth_code
 
     async def _get_access_token(self):
-        """Get access token using authorization code flow"""
+        """Get access token from the token cache, falling back to the authorization code flow"""
         try:
+            if self.app is None:
+                self.app = self._create_msal_app()
+
+            # Reuse or silently refresh a cached token
+            accounts = self.app.get_accounts()
+            if accounts:
+                result = self.app.acquire_token_silent(GRAPH_SCOPES, account=accounts[0])
+                if result and "access_token" in result:
+                    _save_token_cache()
+                    logger.info("Token loaded from cache!")
+                    return result["access_token"]
+
             # Get authorization code
             auth_code = await self._get_auth_code()
             
             # Get token using auth code
             result = self.app.acquire_token_by_authorization_code(
                 code=auth_code,
-                scopes=["https://graph.microsoft.com/Mail.ReadWrite"],
+                scopes=GRAPH_SCOPES,
                 redirect_uri="http://localhost:8000/callback"
             )
             
             if "access_token" in result:
-                print("Token obtained successfully!")
+                _save_token_cache()
+                logger.info("Token obtained successfully!")
                 return result["access_token"]
             else:
-                print("Token acquisition failed!")
-                print("Error:", result.get("error"))
+                logger.error("Token acquisition failed! Error: %s", result.get("error"))
                 raise Exception(f"Could not obtain access token: {result.get('error_description')}")
                 
         except Exception as e:
-            print(f"Authentication error: {str(e)}")
+            logger.error("Authentication error: %s", e)
             raise
 
+    async def _get_token(self):
+        """Current access token; MSAL serves it from memory and silently refreshes it near expiry"""
+        accounts = self.app.get_accounts() if self.app is not None else []
+        if accounts:
+            result = await asyncio.to_thread(self.app.acquire_token_silent, GRAPH_SCOPES, account=accounts[0])
+            if result and "access_token" in result:
+                self.token = result["access_token"]
+                _save_token_cache()
+        return self.token
+
     async def _get_session(self):
-        """Get or create aiohttp session with SSL context"""
-        if self.session is None or self.session.closed:
-            ssl_context = ssl.create_default_context(cafile=certifi.where())
-            connector = aiohttp.TCPConnector(ssl=ssl_context)
-            self.session = aiohttp.ClientSession(connector=connector)
-        return self.session
-
-    async def _make_request(self, method, endpoint, payload=None):
+        """Get or create the process-wide aiohttp session with a pooled keep-alive connector"""
+        global _session
+        if _session is None or _session.closed:
+            connector = aiohttp.TCPConnector(
+                ssl=_SSL_CTX,
+                limit=32,
+                limit_per_host=16,
+                ttl_dns_cache=300,
+                keepalive_timeout=75,
+                enable_cleanup_closed=True
+            )
+            _session = aiohttp.ClientSession(connector=connector)
+        return _session
+
+    async def _make_request(self, method, endpoint, payload=None, extra_headers=None):
         """Make async request to Microsoft Graph API"""
         if not self.email_address:
             raise ValueError("email_address must be set before making requests")
 
         headers = {
-            "Authorization": f"Bearer {self.token}",
+            "Authorization": f"Bearer {await self._get_token()}",
             "Content-Type": "application/json",
+            **(extra_headers or {}),
         }
 
         url = f"{self.base_url}{endpoint}"
         session = await self._get_session()
         
         try:
-            async with session.request(method, url, headers=headers, json=payload, ssl=False) as response:
+            data = _json_dumps(payload) if payload is not None else None
+            async with session.request(method, url, headers=headers, data=data) as response:
                 if response.status in [200, 201]:
-                    return await response.json()
+                    return _json_loads(await response.read())
                 else:
                     text = await response.text()
                     raise Exception(f"Error: {response.status}, {text}")
         except Exception as e:
-            print(f"Request error for {url}: {str(e)}")
+            logger.debug("Request error for %s: %s", url, e)
             raise
 
+    async def _stream_request(self, endpoint, extra_headers=None, links=None):
+        """
+        GET a Graph collection, yielding the items of its "value" array as they are parsed.
+
+        Args:
+            endpoint: Relative Graph endpoint
+            extra_headers: Headers added to the request
+            links: Optional dict that receives the top-level @odata.* links (nextLink, deltaLink)
+        """
+        if ijson is None:
+            page = await self._make_request("GET", endpoint, extra_headers=extra_headers)
+            if links is not None:
+                links.update((key, value) for key, value in page.items() if key.startswith('@odata.'))
+            for item in page.get('value', []):
+                yield item
+            return
+
+        headers = {
+            "Authorization": f"Bearer {await self._get_token()}",
+            **(extra_headers or {}),
+        }
+        url = f"{self.base_url}{endpoint}"
+        session = await self._get_session()
+
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status != 200:
+                    text = await response.text()
+                    raise Exception(f"Error: {response.status}, {text}")
+
+                builder = None
+                async for prefix, event, value in ijson.parse_async(response.content, use_float=True):
+                    if builder is not None:
+                        builder.event(event, value)
+                        if prefix == 'value.item' and event == 'end_map':
+                            yield builder.value
+                            builder = None
+                    elif prefix == 'value.item' and event == 'start_map':
+                        builder = ObjectBuilder()
+                        builder.event(event, value)
+                    elif links is not None and prefix.startswith('@odata.') and event == 'string':
+                        links[prefix] = value
+        except Exception as e:
+            logger.debug("Request error for %s: %s", url, e)
+            raise
+
+    async def _batch_request(self, requests):
+        """
+        Send sub-requests through Graph's JSON batching endpoint, 20 per round trip.
+
+        Args:
+            requests: List of {"id", "method", "url", ...} sub-request dicts
+
+        Returns:
+            Dict mapping each sub-request id to its response ({"status", "headers", "body"})
+        """
+        responses = {}
+        for i in range(0, len(requests), GRAPH_BATCH_LIMIT):
+            batch = await self._make_request(
+                "POST", "/$batch", payload={"requests": requests[i:i + GRAPH_BATCH_LIMIT]}
+            )
+            for response in batch.get('responses', []):
+                responses[response['id']] = response
+        return responses
+
     async def fetch_unanswered_emails(self, max_results=50):
         """Fetch unanswered emails from Outlook"""
         try:
-            endpoint = f"/users/{self.email_address}/messages?$top={max_results}&$orderby=receivedDateTime desc"
-            emails = await self._make_request("GET", endpoint)
+            endpoint = (
+                f"/users/{self.email_address}/messages?$top={max_results}"
+                f"&$select={MESSAGE_SELECT}&$filter={MESSAGE_FILTER}&$orderby=receivedDateTime desc"
+            )
+            emails = await self._make_request("GET", endpoint, extra_headers=TEXT_BODY_HEADERS)
             return emails.get('value', [])
         except Exception as e:
-            print(f"Error fetching Outlook emails: {e}")
+            logger.error("Error fetching Outlook emails: %s", e)
             return []
 
     async def create_draft_reply(self, initial_email, reply_text):
@@ -161,7 +354,7 @@ class OutlookTools(BaseEmailTool):
             endpoint = f"/users/{self.email_address}/messages"
             return await self._make_request("POST", endpoint, payload=message)
         except Exception as e:
-            print(f"Error creating draft: {e}")
+            logger.error("Error creating draft: %s", e)
             return None
 
     async def send_reply(self, initial_email, reply_text):
@@ -181,24 +374,25 @@ class OutlookTools(BaseEmailTool):
             endpoint = f"/users/{self.email_address}/sendMail"
             return await self._make_request("POST", endpoint, payload=message)
         except Exception as e:
-            print(f"Error sending reply: {e}")
+            logger.error("Error sending reply: %s", e)
             return None
 
     async def fetch_draft_replies(self):
         """Fetch draft emails from Outlook"""
         try:
-            endpoint = f"/users/{self.email_address}/mailFolders/drafts/messages"
+            endpoint = f"/users/{self.email_address}/mailFolders/drafts/messages?$select=id,conversationId"
             drafts = await self._make_request("GET", endpoint)
             return drafts.get('value', [])
         except Exception as e:
-            print(f"Error fetching drafts: {e}")
+            logger.error("Error fetching drafts: %s", e)
             return []
 
     async def cleanup(self):
         """Cleanup resources"""
-        if self.session and not self.session.closed:
-            await self.session.close()
-            self.session = None
+        global _session
+        if _session and not _session.closed:
+            await _session.close()
+            _session = None
             # Wait for any pending requests to complete
             await asyncio.sleep(0.1)
 
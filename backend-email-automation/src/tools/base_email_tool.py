@@ -70,6 +70,21 @@ class BaseEmailTool(ABC):
         """
         pass
 
+    async def acknowledge_emails(self, processed_ids: List[str], failed_ids: List[str]) -> None:
+        """
+        Report which emails returned by fetch_unanswered_emails the workflow processed,
+        and which it failed on and should be offered again.
+        Services that re-list unanswered emails on every fetch have nothing to record.
+        """
+        pass
+
+    async def flush_sends(self) -> None:
+        """
+        Send any replies queued by send_reply.
+        Services that send immediately have nothing to flush.
+        """
+        pass
+
     async def __aenter__(self):
         """Async context manager entry"""
         return self
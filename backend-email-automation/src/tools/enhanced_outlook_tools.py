@@ -1,7 +1,35 @@
-from .OutlookTools import OutlookTools
+from .OutlookTools import OutlookTools, CACHE_DIR, GRAPH_BATCH_LIMIT, MESSAGE_SELECT, MESSAGE_FILTER, TEXT_BODY_HEADERS
 from .base_email_tool import BaseEmailTool
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from urllib.parse import quote
+import numpy as np
 import os
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Inbox delta sync state per mailbox: the position to resume from (@odata.deltaLink, or the
+# @odata.nextLink of an unfinished round), so each poll only transfers new or changed messages,
+# and the ids of emails the pipeline failed on, fetched again by id until they're answered
+DELTA_LINK_PATH = os.path.join(CACHE_DIR, "outlook_delta.json")
+# How far back the first delta sync of a mailbox reaches
+INITIAL_SYNC_DAYS = 7
+# Attempts per flush_sends for replies Graph throttles (429) or fails server-side (5xx),
+# and the longest Retry-After honoured between them; the rest wait for the next flush
+SEND_ATTEMPTS = 3
+MAX_SEND_RETRY_WAIT = 30
+# Recently returned message ids, so messages that merely changed (e.g. were read) aren't processed twice
+PROCESSED_IDS_LIMIT = 1000
+
+def _load_sync_state():
+    """Load the persisted delta sync state, keyed by mailbox address"""
+    try:
+        with open(DELTA_LINK_PATH) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
 
 class EnhancedOutlookTools(OutlookTools):
     def __init__(self, email_address):
@@ -23,7 +51,19 @@ class EnhancedOutlookTools(OutlookTools):
         
         super().__init__(client_id, client_secret, tenant_id)
         self.email_address = email_address
+        # Lowercased once for the per-email sender check
+        self._own_address = email_address.lower()
         self._initialized = False
+        sync_state = _load_sync_state().get(email_address) or {}
+        if isinstance(sync_state, str):  # Saved before failed ids were tracked
+            sync_state = {"deltaLink": sync_state}
+        self._delta_link = sync_state.get("deltaLink")
+        self._retry_ids = set(sync_state.get("retryIds", []))
+        # Where the last fetched round ends, committed by acknowledge_emails
+        self._pending_delta_link = None
+        self._processed_ids = OrderedDict()
+        # sendMail bodies queued by send_reply until the next flush_sends
+        self._pending_sends = []
 
     async def ensure_initialized(self):
         """Ensure the client is initialized with valid tokens"""
@@ -32,40 +72,177 @@ class EnhancedOutlookTools(OutlookTools):
                 await self.initialize()
                 self._initialized = True
             except Exception as e:
-                print(f"Failed to initialize Outlook client: {str(e)}")
+                logger.error("Failed to initialize Outlook client: %s", e)
                 raise
 
-    async def fetch_unanswered_emails(self, max_results=50):
-        """Fetch unanswered emails from Outlook"""
+    async def fetch_unanswered_emails(self, max_results=50, max_age_days=INITIAL_SYNC_DAYS):
+        """
+        Fetch new unanswered inbox emails from Outlook using an incremental delta sync.
+        Delta pages are read until max_results messages are reached, so a call reads fewer than
+        2 * max_results; a longer round resumes on the next call. The round only counts as done
+        once acknowledge_emails reports how the pipeline fared on the returned emails.
+        """
         await self.ensure_initialized()
         try:
-            # Fetch recent emails
-            emails = await self.fetch_emails(top=max_results)
-            unanswered_emails = []
+            page_headers = {"Prefer": f'{TEXT_BODY_HEADERS["Prefer"]}, odata.maxpagesize={max_results}'}
 
-            # Get draft emails
-            drafts = await self.fetch_draft_replies()
+            # Fetch the first inbox delta page, the drafts and the emails to retry in a single round trip
+            retry_ids = list(self._retry_ids)
+            responses = await self._batch_request([
+                {
+                    "id": "inbox",
+                    "method": "GET",
+                    "url": self._inbox_delta_url(),
+                    "headers": page_headers
+                },
+                {
+                    "id": "drafts",
+                    "method": "GET",
+                    "url": "/me/mailFolders/drafts/messages?$select=conversationId"
+                }
+            ] + [
+                {
+                    "id": f"retry-{i}",
+                    "method": "GET",
+                    "url": f"/me/messages/{quote(message_id, safe='')}?$select={MESSAGE_SELECT},isDraft",
+                    "headers": TEXT_BODY_HEADERS
+                }
+                for i, message_id in enumerate(retry_ids)
+            ])
+            if responses.get("inbox", {}).get('status') == 410:
+                # Delta token expired, start over with a fresh sync
+                logger.info("Outlook delta token expired, resyncing inbox")
+                self._delta_link = None
+                first_page = await self._make_request("GET", self._inbox_delta_url(), extra_headers=page_headers)
+            else:
+                first_page = self._batch_response_body(responses, "inbox")
+            emails = await self._read_delta_pages(first_page, page_headers, max_results)
+            drafts = self._batch_response_body(responses, "drafts").get('value', [])
             threads_with_drafts = {draft.get('conversationId') for draft in drafts}
 
-            for email in emails.get('value', []):
-                if (email.get('conversationId') not in threads_with_drafts and 
-                    not self._should_skip_email(email)):
-                    email_info = self._get_email_info(email)
-                    unanswered_emails.append(email_info)
+            retried = []
+            for i, message_id in enumerate(retry_ids):
+                response = responses.get(f"retry-{i}", {})
+                if response.get('status') == 200:
+                    retried.append(response['body'])
+                elif response.get('status') == 404:
+                    # Deleted since, nothing left to answer
+                    self._retry_ids.discard(message_id)
+            # The delta round's copy wins, it may report the message as removed
+            emails = {email['id']: email for email in retried + emails}.values()
+
+            emails = [email for email in emails if '@removed' not in email and not email.get('isDraft')]
+            # Age cutoff over all timestamps at once; delta rounds also return old messages that changed
+            received = np.array([(email.get('receivedDateTime') or '')[:19] for email in emails], dtype='datetime64[s]')
+            recent = received > np.datetime64('now', 's') - np.timedelta64(max_age_days, 'D')
+
+            unanswered_emails = []
+            for email, is_recent in zip(emails, recent.tolist()):
+                if (not is_recent or
+                    email['id'] in self._processed_ids or
+                    email.get('conversationId') in threads_with_drafts or
+                    self._should_skip_email(email)):
+                    self._retry_ids.discard(email['id'])
+                    continue
+                unanswered_emails.append(self._get_email_info(email))
 
+            if not unanswered_emails:
+                # Nothing for the pipeline, the round is done
+                await self.acknowledge_emails([], [])
             return unanswered_emails
         except Exception as e:
-            print(f"Error fetching Outlook emails: {e}")
+            logger.error("Error fetching Outlook emails: %s", e)
             return []
 
+    def _inbox_delta_url(self):
+        """Relative URL of the next inbox delta round: the saved delta link, or a fresh initial sync"""
+        if self._delta_link:
+            return self._relative_url(self._delta_link)
+        since = np.datetime_as_string(np.datetime64('now', 's') - np.timedelta64(INITIAL_SYNC_DAYS, 'D')) + 'Z'
+        return f"/me/mailFolders/inbox/messages/delta?$select={MESSAGE_SELECT},isDraft&$filter=receivedDateTime ge {since}"
+
+    def _relative_url(self, link):
+        """Strip the Graph base URL from an @odata link so it can be used as an endpoint"""
+        return link[len(self.base_url):] if link.startswith(self.base_url) else link
+
+    async def _read_delta_pages(self, page, headers, limit):
+        """Collect messages across @odata.nextLink pages until `limit`, and note where to resume"""
+        emails = list(page.get('value', []))
+        while '@odata.nextLink' in page and len(emails) < limit:
+            # Stream later pages so messages are parsed as their bytes arrive
+            endpoint = self._relative_url(page['@odata.nextLink'])
+            page = {}
+            async for email in self._stream_request(endpoint, extra_headers=headers, links=page):
+                emails.append(email)
+        # Either the rest of this round or, once it's done, the next one
+        resume_link = page.get('@odata.nextLink') or page.get('@odata.deltaLink')
+        self._pending_delta_link = resume_link
+        return emails
+
+    async def acknowledge_emails(self, processed_ids, failed_ids):
+        """Commit the last fetched delta round once the pipeline has run on its emails"""
+        for message_id in processed_ids:
+            self._mark_processed(message_id)
+            self._retry_ids.discard(message_id)
+        # The delta round moves past failed emails, so they're fetched by id on the next poll
+        self._retry_ids.update(failed_ids)
+        if self._pending_delta_link:
+            self._delta_link = self._pending_delta_link
+            self._pending_delta_link = None
+        self._save_sync_state()
+
+    def _save_sync_state(self):
+        """Persist this mailbox's delta sync state alongside the other mailboxes'"""
+        sync_state = _load_sync_state()
+        sync_state[self.email_address] = {"deltaLink": self._delta_link, "retryIds": sorted(self._retry_ids)}
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(DELTA_LINK_PATH, "w") as f:
+            json.dump(sync_state, f)
+
+    def _mark_processed(self, message_id):
+        """Remember a processed message id, evicting the oldest beyond PROCESSED_IDS_LIMIT"""
+        self._processed_ids[message_id] = None
+        if len(self._processed_ids) > PROCESSED_IDS_LIMIT:
+            self._processed_ids.popitem(last=False)
+
+    def _batch_response_body(self, responses, request_id):
+        """Get the body of one $batch sub-response, or {} if it failed"""
+        response = responses.get(request_id)
+        if response is None or response.get('status') not in [200, 201]:
+            logger.error("Batch request '%s' failed: %s", request_id, response)
+            return {}
+        return response.get('body', {})
+
+    def _should_skip_email(self, email):
+        """Check if email should be skipped (sent by this mailbox)"""
+        sender = ((email.get('from') or {}).get('emailAddress') or {}).get('address') or ''
+        return sender.lower() == self._own_address
+
+    def _get_email_info(self, email):
+        """Map a Graph message to the common email dictionary format"""
+        return {
+            "id": email.get("id"),
+            "threadId": email.get("conversationId"),
+            "messageId": email.get("internetMessageId", ""),
+            "references": "",
+            "sender": ((email.get("from") or {}).get("emailAddress") or {}).get("address") or "Unknown",
+            "subject": email.get("subject") or "No Subject",
+            "body": (email.get("body") or {}).get("content") or "",
+            "isUnread": not email.get("isRead", True),
+            "labels": email.get("categories", [])
+        }
+
     async def fetch_emails(self, folder="inbox", top=10):
         """Fetch recent emails from a specified folder."""
         await self.ensure_initialized()
         try:
-            endpoint = f"/me/mailFolders/{folder}/messages?$top={top}&$orderby=receivedDateTime DESC"
-            return await self._make_request("GET", endpoint)
+            endpoint = (
+                f"/me/mailFolders/{folder}/messages?$top={top}"
+                f"&$select={MESSAGE_SELECT}&$filter={MESSAGE_FILTER}&$orderby=receivedDateTime DESC"
+            )
+            return await self._make_request("GET", endpoint, extra_headers=TEXT_BODY_HEADERS)
         except Exception as e:
-            print(f"Error fetching emails: {e}")
+            logger.error("Error fetching emails: %s", e)
             return {"value": []}
 
     async def create_draft_reply(self, initial_email, reply_text):
@@ -78,28 +255,95 @@ class EnhancedOutlookTools(OutlookTools):
                 to_emails=[initial_email.sender]
             )
         except Exception as e:
-            print(f"Error creating Outlook draft: {e}")
+            logger.error("Error creating Outlook draft: %s", e)
             return None
 
     async def fetch_draft_replies(self):
         """Fetch draft emails from Outlook"""
         await self.ensure_initialized()
         try:
-            return (await self._make_request("GET", "/me/mailFolders/drafts/messages")).get('value', [])
+            return (await self._make_request("GET", "/me/mailFolders/drafts/messages?$select=id,conversationId")).get('value', [])
         except Exception as e:
-            print(f"Error fetching Outlook drafts: {e}")
+            logger.error("Error fetching Outlook drafts: %s", e)
             return []
 
     async def send_reply(self, initial_email, reply_text):
-        """Send a reply email using Outlook"""
+        """Queue a reply email, sent with the next flush_sends batch"""
+        message = {
+            "message": {
+                "subject": f"Re: {initial_email.subject}",
+                "body": {
+                    "contentType": "HTML",
+                    "content": reply_text
+                },
+                "toRecipients": [{"emailAddress": {"address": initial_email.sender}}]
+            },
+            "saveToSentItems": "true"
+        }
+        self._pending_sends.append(message)
+        return message
+
+    async def flush_sends(self):
+        """Send all queued replies through Graph $batch, retrying throttled and server-failed ones"""
+        if not self._pending_sends:
+            return
         await self.ensure_initialized()
+        for attempt in range(SEND_ATTEMPTS):
+            pending, self._pending_sends = self._pending_sends, []
+            retry_after = await self._send_batches(pending)
+            if not self._pending_sends:
+                return
+            if attempt < SEND_ATTEMPTS - 1:
+                await asyncio.sleep(min(retry_after, MAX_SEND_RETRY_WAIT))
+        logger.warning("%d Outlook replies still throttled, keeping them for the next flush", len(self._pending_sends))
+
+    async def _send_batches(self, messages):
+        """
+        Send sendMail bodies 20 per $batch call, queueing the ones to retry again.
+
+        Returns:
+            Seconds Graph asked to wait before retrying (Retry-After), 0 if nothing was throttled
+        """
+        retry_after = 0
+        for start in range(0, len(messages), GRAPH_BATCH_LIMIT):
+            chunk = messages[start:start + GRAPH_BATCH_LIMIT]
+            try:
+                responses = await self._batch_request([
+                    {
+                        "id": str(i),
+                        "method": "POST",
+                        "url": f"/users/{self.email_address}/sendMail",
+                        "body": message,
+                        "headers": {"Content-Type": "application/json"}
+                    }
+                    for i, message in enumerate(chunk)
+                ])
+            except Exception:
+                # This chunk and the ones after it weren't sent, keep them for the next flush
+                self._pending_sends.extend(messages[start:])
+                raise
+
+            for i, message in enumerate(chunk):
+                response = responses.get(str(i))
+                status = response.get('status') if response else None
+                if status == 202:
+                    continue
+                if status is None or status == 429 or status >= 500:
+                    # Throttled or transient, send it again
+                    self._pending_sends.append(message)
+                    headers = (response or {}).get('headers') or {}
+                    try:
+                        retry_after = max(retry_after, int(headers.get('Retry-After', 1)))
+                    except ValueError:
+                        retry_after = max(retry_after, 1)
+                else:
+                    logger.error("Error sending Outlook reply '%s': %s", message["message"]["subject"], response)
+        return retry_after
+
+    async def cleanup(self):
+        """Send any queued replies, then close the shared session"""
         try:
-            return await self.send_email(
-                from_email=self.email_address,
-                to_emails=[initial_email.sender],
-                subject=f"Re: {initial_email.subject}",
-                body=reply_text
-            )
+            await self.flush_sends()
         except Exception as e:
-            print(f"Error sending Outlook reply: {e}")
-            return None
\ No newline at end of file
+            logger.error("Error flushing Outlook replies: %s", e)
+        await super().cleanup()
\ No newline at end of file